@@ -1,11 +1,12 @@
 import os
 import re
-import csv
-import requests
+import urllib3
 import datetime
 import json
 import time
 import random
+import functools
+import threading
 import gspread
 from google.oauth2.service_account import Credentials
 
@@ -14,6 +15,7 @@ REDFIN_URL = os.getenv("REDFIN_URL", "https://www.redfin.com/RI/Providence/384-B
 SCRAPER_URL = os.getenv("SCRAPER_URL", "http://localhost:5006/scrape")
 SHEET_URL = os.getenv("SHEET_URL", "https://docs.google.com/spreadsheets/d/1OrContixGYzHNT_DaO76p3rP1nvNamRs9r3fuJLsf-k/edit")
 GOOGLE_SHEETS_CREDENTIALS = os.getenv("GOOGLE_SHEETS_CREDENTIALS") # Raw JSON string
+SHEET_NAME = "Redfin"
 HISTORY_FILE = "redfin_price_history.csv"
 
 # Browser-like headers to help bypass firewalls
@@ -26,69 +28,162 @@ HEADERS = {
     "Upgrade-Insecure-Requests": "1"
 }
 
+# Retry backoff bounds (seconds) for non-CAPTCHA failures
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+class ScrapeBlockedError(Exception):
+    """Raised when the scrape is blocked by a WAF or CAPTCHA challenge."""
+
+# Shared pool so scrape retries reuse the keep-alive connection; urllib3 is
+# used directly since the scraper call is a single streamed POST
+_HTTP = urllib3.PoolManager(num_pools=2, maxsize=2, retries=False)
+
+# Precompiled patterns used on every scrape
+_DOLLAR_RE = re.compile(rb'\$[\d,]')
+_DIGITS_RE = re.compile(rb'[\d,]+')
+_JSON_VALUE_RE = re.compile(rb'\s*"\\?\$([\d,]+)')
+_BOUNDARY_RE = re.compile(r'boundary=(.*)')
+
+# How far past a price marker's tag to look for the '$' amount
+PRICE_SEARCH_WINDOW = 2048
+
+def _price_after_marker(html_content, marker):
+    """
+    Return the first '$NNN,NNN' amount following the tag that contains marker.
+    Works on raw bytes; only the matched digits are decoded.
+    The marker is located with a literal find() and the '$' is searched only
+    within PRICE_SEARCH_WINDOW bytes of the tag, so a missing price never
+    scans the rest of the document.
+    """
+    start = html_content.find(marker)
+    if start == -1:
+        return None
+    pos = html_content.find(b">", start + len(marker))
+    if pos == -1:
+        return None
+
+    dollar_match = _DOLLAR_RE.search(html_content, pos, pos + PRICE_SEARCH_WINDOW)
+    if not dollar_match:
+        return None
+    # Match the digit run unbounded so a price straddling the window is kept whole
+    digits_match = _DIGITS_RE.match(html_content, dollar_match.start() + 1)
+    return digits_match.group(0).decode("ascii")
+
+def _price_from_json(html_content):
+    """Return the amount from a '"sectionPreviewText":"$NNN,NNN"' JSON field."""
+    marker = b'"sectionPreviewText":'
+    pos = html_content.find(marker)
+    while pos != -1:
+        pos += len(marker)
+        value_match = _JSON_VALUE_RE.match(html_content, pos)
+        if value_match:
+            return value_match.group(1).decode("ascii")
+        pos = html_content.find(marker, pos)
+    return None
+
 def extract_price(html_content):
     """
-    Extract the Redfin Estimate price from the HTML content.
+    Extract the Redfin Estimate price from the raw HTML bytes.
     Targeting the 'abp-price' test ID which Redfin uses for the main price display.
     """
     # Primary: target the abp-price container (current estimate)
-    abp_match = re.search(
-        r'data-rf-test-id="abp-price"[^>]*>.*?\$([\d,]+)',
-        html_content, re.DOTALL
-    )
-    if abp_match:
-        return abp_match.group(1)
+    price = _price_after_marker(html_content, b'data-rf-test-id="abp-price"')
+    if price:
+        return price
 
     # Fallback: RedfinEstimateValueHeader section
-    esth_match = re.search(
-        r'RedfinEstimateValueHeader[^>]*>.*?\$([\d,]+)',
-        html_content, re.DOTALL
-    )
-    if esth_match:
-        return esth_match.group(1)
+    price = _price_after_marker(html_content, b"RedfinEstimateValueHeader")
+    if price:
+        return price
 
     # Fallback 2: JSON blob "sectionPreviewText":"$NNN,NNN"
-    json_match = re.search(r'"sectionPreviewText":\s*"\\?\$([\d,]+)', html_content)
-    if json_match:
-        return json_match.group(1)
+    return _price_from_json(html_content)
 
-    return None
+def _iter_multipart_parts(chunks, boundary):
+    """
+    Yield the raw segments between multipart boundaries as chunks arrive.
+    Equivalent to content.split(b"--" + boundary) without buffering the whole
+    response or building the list of parts.
+    """
+    delimiter = b"--" + boundary
+    buffer = bytearray()
+    for chunk in chunks:
+        # Resume just before the new data in case the delimiter straddles chunks
+        search_from = max(0, len(buffer) - len(delimiter) + 1)
+        buffer.extend(chunk)
+        start = 0
+        idx = buffer.find(delimiter, search_from)
+        while idx != -1:
+            # Slice through a memoryview so each part is copied only once
+            with memoryview(buffer) as view:
+                part = view[start:idx].tobytes()
+            yield part
+            start = idx + len(delimiter)
+            idx = buffer.find(delimiter, start)
+        # Drop consumed parts in one shift rather than once per part
+        del buffer[:start]
+    yield bytes(buffer)
 
-def update_google_sheet(price_str):
+@functools.lru_cache(maxsize=1)
+def _get_spreadsheet():
+    """
+    Authorize with the service account and open the tracking spreadsheet.
+    Cached so repeated updates in one process reuse the client and handle.
+    """
+    scope = ["https://www.googleapis.com/auth/spreadsheets"]
+    creds_dict = json.loads(GOOGLE_SHEETS_CREDENTIALS)
+    service_account_email = creds_dict.get("client_email")
+    print(f"Using service account: {service_account_email}")
+    
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    client = gspread.authorize(creds)
+    
+    # Open by URL; the "Redfin" tab is addressed by A1 range so no
+    # separate worksheet metadata lookup is needed
+    return client.open_by_url(SHEET_URL)
+
+def _warm_spreadsheet():
+    """Open the spreadsheet ahead of time; errors resurface in update_google_sheet."""
+    try:
+        _get_spreadsheet()
+    except Exception:
+        pass
+
+def update_google_sheet(price_str, now):
     if not GOOGLE_SHEETS_CREDENTIALS:
         print("Warning: GOOGLE_SHEETS_CREDENTIALS not set, skipping sheet update.")
         return
 
     try:
-        scope = ["https://www.googleapis.com/auth/spreadsheets"]
-        creds_dict = json.loads(GOOGLE_SHEETS_CREDENTIALS)
-        service_account_email = creds_dict.get("client_email")
-        print(f"Using service account: {service_account_email}")
-        
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        
-        # Open by URL and select "Redfin" sheet
-        sh = client.open_by_url(SHEET_URL)
-        worksheet = sh.worksheet("Redfin")
+        sh = _get_spreadsheet()
         
         # Today's date in format DD-MM-YYYY
-        today_str = datetime.datetime.now().strftime("%d-%m-%Y")
+        today_str = now.strftime("%d-%m-%Y")
         print(f"Searching for date: {today_str} in Column A...")
         
-        # Get all values in Column A
-        col_a = worksheet.col_values(1)
+        # Get all values in Column A (empty cells come back as empty rows)
+        value_ranges = sh.values_batch_get([f"{SHEET_NAME}!A:A"])["valueRanges"]
+        col_a = [row[0] if row else "" for row in value_ranges[0].get("values", [])]
         
-        row_index = -1
-        for i, val in enumerate(col_a):
-            if today_str in val:
-                row_index = i + 1 # 1-indexed
-                break
+        # Exact match is a C-level scan; fall back to substring matching for
+        # cells that carry extra text around the date
+        try:
+            row_index = col_a.index(today_str) + 1 # 1-indexed
+        except ValueError:
+            row_index = -1
+            for i, val in enumerate(col_a):
+                if today_str in val:
+                    row_index = i + 1
+                    break
         
         if row_index != -1:
             # Update Column C (index 3)
             val_to_put = f"${price_str}"
-            worksheet.update_cell(row_index, 3, val_to_put)
+            sh.values_batch_update({
+                "valueInputOption": "USER_ENTERED",
+                "data": [{"range": f"{SHEET_NAME}!C{row_index}", "values": [[val_to_put]]}]
+            })
             print(f"✓ Updated Google Sheet row {row_index}, Column C with: {val_to_put}")
         else:
             print(f"Warning: Could not find row for date {today_str} in Column A.")
@@ -97,7 +192,11 @@ def update_google_sheet(price_str):
         print(f"Error updating Google Sheet: {e}")
 
 def run_scrape():
-    """Performs a single scrape attempt."""
+    """
+    Performs a single scrape attempt.
+    Returns the price string or None, and raises ScrapeBlockedError when a
+    WAF/CAPTCHA block is detected.
+    """
     print(f"[{datetime.datetime.now()}] Attempting scrape for: {REDFIN_URL}")
     
     payload = {
@@ -107,40 +206,51 @@ def run_scrape():
     }
 
     try:
-        response = requests.post(SCRAPER_URL, json=payload, stream=True, timeout=60)
+        response = _HTTP.request(
+            "POST", SCRAPER_URL,
+            body=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+            preload_content=False, timeout=60
+        )
         
         # Identifty Amazon WAF or general CAPTCHA
         is_waf_captcha = 'captcha' in response.headers.get('x-amzn-waf-action', '').lower()
         if is_waf_captcha:
             print("! Blocked by Amazon WAF CAPTCHA firewall")
-            return None
+            raise ScrapeBlockedError("Amazon WAF CAPTCHA")
 
         # Parse response parts
         content_type = response.headers.get("Content-Type", "")
-        boundary_match = re.search(r'boundary=(.*)', content_type)
+        boundary_match = _BOUNDARY_RE.search(content_type)
         if not boundary_match:
             print("Error: Multipart boundary not found")
             return None
 
-        boundary = boundary_match.group(1)
-        parts = response.content.split(f"--{boundary}".encode())
+        boundary = boundary_match.group(1).encode()
+        parts = _iter_multipart_parts(response.stream(65536), boundary)
 
-        html_content = ""
+        html_content = b""
         for part in parts:
             if len(part) < 500:
                 continue
             header_end = part.find(b"\r\n\r\n")
             if header_end == -1:
                 continue
-            body = part[header_end+4:].decode('utf-8', errors='ignore')
+            body = part[header_end+4:]
 
             # Detect CAPTCHA indicators in body
-            if "captcha" in body.lower() and "verify" in body.lower():
+            lowered = body.lower()
+            if b"captcha" in lowered and b"verify" in lowered:
                 print("! CAPTCHA challenge detected in page content")
-                return None
+                raise ScrapeBlockedError("CAPTCHA challenge in page content")
                 
-            if "data-rf-test-id" in body and len(body) > len(html_content):
+            # The first part carrying Redfin markup is the page document
+            if b"data-rf-test-id" in body:
                 html_content = body
+                break
+
+        # Stop reading any remaining parts
+        response.close()
 
         if not html_content:
             print("Error: Could not find meaningful HTML in response")
@@ -148,6 +258,8 @@ def run_scrape():
 
         return extract_price(html_content)
 
+    except ScrapeBlockedError:
+        raise
     except Exception as e:
         print(f"Scrape attempt failed: {e}")
         return None
@@ -155,14 +267,33 @@ def run_scrape():
 def main():
     max_retries = 3
     price_str = None
+    blocked = False
+    prev_wait = BACKOFF_BASE
+
+    # Authorize and open the sheet while the scrape is in flight
+    sheet_warmup = None
+    if GOOGLE_SHEETS_CREDENTIALS:
+        sheet_warmup = threading.Thread(target=_warm_spreadsheet, daemon=True)
+        sheet_warmup.start()
 
     for attempt in range(max_retries):
         if attempt > 0:
-            wait_time = random.randint(20, 60)
-            print(f"Waiting {wait_time}s before retry {attempt+1}/{max_retries}...")
+            if blocked:
+                # Give the firewall time to cool down
+                wait_time = random.randint(20, 60)
+            else:
+                # Decorrelated jitter for transient failures
+                wait_time = min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, prev_wait * 3))
+                prev_wait = wait_time
+            print(f"Waiting {wait_time:.0f}s before retry {attempt+1}/{max_retries}...")
             time.sleep(wait_time)
 
-        price_str = run_scrape()
+        try:
+            price_str = run_scrape()
+            blocked = False
+        except ScrapeBlockedError:
+            price_str = None
+            blocked = True
         if price_str:
             break
         
@@ -171,18 +302,23 @@ def main():
         return
 
     print(f"Success! Final Price Extracted: ${price_str}")
-    update_google_sheet(price_str)
+    # One timestamp for both the sheet row lookup and the CSV backup
+    now = datetime.datetime.now()
+    if sheet_warmup:
+        sheet_warmup.join()
+    update_google_sheet(price_str, now)
 
     # Local backup
     price_numeric = price_str.replace(",", "")
     file_exists = os.path.isfile(HISTORY_FILE)
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-    with open(HISTORY_FILE, "a", newline="") as f:
-        writer = csv.writer(f)
+    # Fields are plain ASCII with no commas, so rows are written directly with
+    # the same \r\n terminator csv.writer used
+    with open(HISTORY_FILE, "ab") as f:
         if not file_exists:
-            writer.writerow(["Timestamp", "Price", "URL"])
-        writer.writerow([timestamp, price_numeric, REDFIN_URL])
+            f.write(b"Timestamp,Price,URL\r\n")
+        f.write(f"{timestamp},{price_numeric},{REDFIN_URL}\r\n".encode())
 
     print(f"Price saved to local backup {HISTORY_FILE}")
 